@@ -1,25 +1,72 @@
 import os
+import threading
 import time
+import orjson
 import requests
-import xml.etree.ElementTree as ET
-from flask import Flask, request, jsonify, render_template
-from openai import OpenAI
+from requests_toolbelt import MultipartEncoder
+from flask import Flask, Response, request, jsonify, render_template, stream_with_context
+from flask.json.provider import JSONProvider
+import httpx
+from openai import OpenAI, DefaultHttpxClient
 from dotenv import load_dotenv
-import json
-import traceback
-import re
+import logging
+import logging.handlers
+import queue
 from supabase import create_client, Client
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from feed import get_available_cars
 
 # Load environment variables
 load_dotenv()
 
+# --- Logging ---
+# Записите минават през QueueHandler към listener на отделна нишка, така че
+# форматирането и IO на лога не блокират нишката, обслужваща заявката.
+_log_queue = queue.SimpleQueue()
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_handler)
+_log_listener.start()
+# Нивото се управлява от LOG_LEVEL (напр. DEBUG локално, INFO в продукция);
+# при INFO всички logger.debug() извиквания по горещите пътища са безплатни.
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
+    handlers=[logging.handlers.QueueHandler(_log_queue)],
+)
+logger = logging.getLogger(__name__)
+
+class OrjsonProvider(JSONProvider):
+    """JSON provider, който сериализира с orjson вместо със стандартния json.
+
+    orjson кодира в C и не escape-ва кирилицата, което е осезаемо по-бързо
+    за отговорите с история на съобщенията и списъци с коли.
+    """
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 # --- Initialize Clients ---
 app = Flask(__name__)
-
-# OpenAI Client
+app.json = OrjsonProvider(app)
+
+# OpenAI Client – синхронен: deploy-ът е WSGI (gunicorn с gthread
+# workers), а Flask async view-та въртят по един event loop на заявка,
+# който умира с връзките на async httpx клиента в него. Конкурентността
+# идва от нишките на worker-а; вдигнатият keep-alive лимит на httpx
+# транспорта позволява конкурентните заявки да преизползват вече
+# отворени TLS връзки към api.openai.com вместо нов handshake.
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-client = OpenAI(api_key=OPENAI_API_KEY)
+_OPENAI_LIMITS = httpx.Limits(max_keepalive_connections=20, max_connections=100)
+client = OpenAI(
+    api_key=OPENAI_API_KEY,
+    http_client=DefaultHttpxClient(limits=_OPENAI_LIMITS),
+)
 ASSISTANT_ID = os.getenv("OPENAI_ASSISTANT_ID")
 # Render задава идентификатора на вектор сториджа чрез променливата
 # "VECTOR_STORE_ID", затова я използваме директно тук. Ако променливата
@@ -32,153 +79,151 @@ supabase_url = os.getenv("SUPABASE_URL")
 supabase_key = os.getenv("SUPABASE_ANON_KEY")
 supabase: Client = create_client(supabase_url, supabase_key)
 
-# Cache for car data to reduce XML fetches
-CAR_CACHE = {"timestamp": 0, "cars": []}
-CACHE_TTL = 300  # seconds
+# Фонов pool за fire-and-forget операции, които не трябва да стоят на
+# критичния път на отговора (submit_tool_outputs, записи в базата).
+_BG = ThreadPoolExecutor(max_workers=4)
+
+# Инструменти и инструкции за Assistants run-овете – еднакви за /chat и
+# /chat/stream, затова са дефинирани веднъж на модулно ниво.
+ASSISTANT_TOOLS = [
+    {"type": "file_search"},
+    {
+        "type": "function",
+        "function": {
+            "name": "get_available_cars",
+            "description": "Извлича списък с налични автомобили от XML фийд. Използвай тази функция, ако потребителят пита за налични коли, цени или конкретни модели.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "model_filter": {
+                        "type": "string",
+                        "description": "Модел на автомобил за филтриране (напр. '208', '3008')."
+                    }
+                },
+                "required": []
+            }
+        }
+    }
+]
+
+ASSISTANT_INSTRUCTIONS = """
+Ти си полезен асистент на Peugeot.
+- За въпроси относно налични автомобили, цени или конкретни модели, ВИНАГИ използвай инструмента `get_available_cars`.
+- За ВСИЧКИ ДРУГИ въпроси (напр. относно услуги, гаранции, политики, технически спецификации), първо потърси отговор в предоставените файлове чрез твоя `file_search` инструмент.
+- Отговаряй на български език.
+"""
+
 
+# Дали log_chat RPC-то съществува в базата: при първата грешка "липсваща
+# функция" (PGRST202) минаваме трайно на директните insert-и, вместо да
+# пробваме RPC-то на всеки ход.
+_LOG_CHAT_AVAILABLE = True
 
-def parse_price(price_str):
-    """Extracts the price in BGN from a string like '35 858,96 € / 70 134,03 лв.'"""
-    if not price_str:
-        return float('inf')
-    
-    # Търсим цена в лева
-    match = re.search(r'([\d\s,]+)\s*лв', price_str)
-    if match:
+
+def _flush_messages(rows, session_id=None, is_new_session=False):
+    """Записва един чат ход (сесия + съобщения) с минимален брой заявки.
+
+    Предпочита RPC-то log_chat (sql/log_chat.sql), което пише сесията и
+    всички съобщения в една транзакция/round-trip; ако функцията липсва в
+    базата (неприложена миграция), пада обратно към отделните insert-и.
+    """
+    global _LOG_CHAT_AVAILABLE
+
+    if session_id is None and rows:
+        session_id = rows[0].get('session_id')
+
+    if _LOG_CHAT_AVAILABLE:
         try:
-            # Премахваме интервали и заменяме запетаи с точки
-            price_clean = match.group(1).replace(' ', '').replace(',', '.')
-            return float(price_clean)
-        except (ValueError, TypeError):
-            print(f"DEBUG: Грешка при парсване на цена: {price_str}")
-            return float('inf')
-    
-    print(f"DEBUG: Не е намерена цена в лева в: {price_str}")
-    return float('inf')
-
-
-def fetch_all_cars():
-    """Fetches and caches car data from the XML feed."""
-    now = time.time()
-    if CAR_CACHE["cars"] and now - CAR_CACHE["timestamp"] < CACHE_TTL:
-        print("DEBUG: Using cached car data")
-        return CAR_CACHE["cars"]
-
-    url = "https://sale.peugeot.bg/ecommerce/fb/product_feed.xml"
-    print(f"DEBUG: Fetching XML from: {url}")
-
-    response = requests.get(url, timeout=15)
-    response.raise_for_status()
-    print(f"DEBUG: XML response status: {response.status_code}")
-
-    root = ET.fromstring(response.content)
-    ns = {'g': 'http://base.google.com/ns/1.0'}
-
-    items = root.findall('.//channel/item')
-    print(f"DEBUG: Намерени общо {len(items)} елемента в XML")
-
-    all_cars = []
-    for item in items:
-        availability_elem = item.find('g:availability', ns)
-        if availability_elem is not None and availability_elem.text == 'in stock':
-            title_elem = item.find('g:title', ns)
-            description_elem = item.find('g:description', ns)
-            link_elem = item.find('g:link', ns)
-            image_elem = item.find('g:image_link', ns)
-
-            title = title_elem.text.strip() if title_elem is not None else "N/A"
-            description = description_elem.text.strip() if description_elem is not None else "N/A"
-            link = link_elem.text if link_elem is not None else "#"
-            image_url = image_elem.text if image_elem is not None else ""
-
-            car_data = {
-                "model": title,
-                "price": description,
-                "link": link,
-                "image_url": image_url
-            }
-            all_cars.append(car_data)
+            supabase.rpc('log_chat', {
+                'p_session_id': session_id,
+                'p_is_new': is_new_session,
+                'p_messages': [
+                    {k: v for k, v in row.items() if k != 'session_id'}
+                    for row in rows
+                ],
+            }).execute()
+            _MSG_CACHE.pop(session_id, None)
+            return
+        except Exception as e:
+            if getattr(e, 'code', None) != 'PGRST202':
+                # Транзиентна грешка (timeout и т.н.): RPC-то може вече да
+                # е комитнало, затова не повтаряме реда през fallback-а –
+                # иначе рискуваме дублирана история.
+                logger.exception("log_chat RPC failed, turn not retried")
+                return
+            # PGRST202 = функцията липсва; RPC-то със сигурност не е писало
+            # нищо, така че fallback-ът е безопасен. Запомняме, за да не
+            # плащаме неуспешния round-trip на всеки следващ ход.
+            _LOG_CHAT_AVAILABLE = False
+            logger.warning("log_chat RPC missing, using direct inserts from now on")
+
+    try:
+        if is_new_session:
+            # upsert с ignore_duplicates вместо insert: повторен опит за
+            # същата сесия не гърми с unique violation и не събаря записа
+            # на съобщенията след него
+            supabase.table('chat_sessions').upsert(
+                {"session_id": session_id},
+                on_conflict='session_id',
+                ignore_duplicates=True,
+            ).execute()
+        supabase.table('chat_messages').insert(rows).execute()
+        _MSG_CACHE.pop(session_id, None)
+    except Exception:
+        logger.exception("Background chat_messages insert failed")
+
+
+# Ограничена опашка + една writer нишка за записите на чат ходове: пътят
+# на отговора само нарежда реда, а ограничението дава backpressure – ако
+# базата изостане, предпочитаме един синхронен запис пред неограничено
+# трупане на памет.
+_WRITE_Q = queue.Queue(maxsize=1000)
+
+
+def _enqueue_flush(rows, session_id=None, is_new_session=False):
+    """Schedules one chat turn for the background writer thread."""
+    try:
+        _WRITE_Q.put_nowait((rows, session_id, is_new_session))
+    except queue.Full:
+        logger.warning("Chat write queue full, flushing synchronously")
+        _flush_messages(rows, session_id=session_id, is_new_session=is_new_session)
+
+
+def _chat_writer_loop():
+    """Източва опашката със записи последователно на фонова нишка."""
+    while True:
+        rows, session_id, is_new_session = _WRITE_Q.get()
+        try:
+            _flush_messages(rows, session_id=session_id, is_new_session=is_new_session)
+        except Exception:
+            logger.exception("Chat writer failed")
+
 
-    CAR_CACHE["timestamp"] = now
-    CAR_CACHE["cars"] = all_cars
-    print(f"DEBUG: Събрани данни за {len(all_cars)} автомобила")
-    return all_cars
+threading.Thread(target=_chat_writer_loop, daemon=True, name="chat-writer").start()
 
 
-def get_available_cars(model_filter=None):
-    """Fetches, filters, sorts by price, and returns the top 2 cheapest cars."""
-    print(f"DEBUG: Calling get_available_cars function. Filter: {model_filter}")
+def _finish_tool_run(thread_id, run_id, tool_outputs, rows, is_new_session=False):
+    """Submits tool outputs and persists chat rows outside the response path.
 
+    Изпълнява се във фоновия pool: резултатът от инструмента е вече върнат
+    на браузъра, затова тук само затваряме run-а (през REST API-то, както
+    правят и админ ендпойнтите) и записваме историята в Supabase.
+    """
     try:
-        all_cars = fetch_all_cars()
-        print(f"DEBUG: Общо налични автомобили: {len(all_cars)}")
-
-        # Филтриране по модел ако е зададен
-        if model_filter:
-            print(f"DEBUG: Филтриране по модел: {model_filter}")
-            filtered_cars = [car for car in all_cars if model_filter.lower() in car['model'].lower()]
-            print(f"DEBUG: След филтриране останаха {len(filtered_cars)} автомобила")
-        else:
-            filtered_cars = list(all_cars)
-
-        # Добавяме числова цена за сортиране без да променяме кешираните данни
-        processed_cars = []
-        for car in filtered_cars:
-            car_copy = car.copy()
-            car_copy['numeric_price'] = parse_price(car_copy['price'])
-            print(f"DEBUG: {car_copy['model']} -> numeric_price: {car_copy['numeric_price']}")
-            processed_cars.append(car_copy)
-
-        # Сортираме по цена
-        sorted_cars = sorted(processed_cars, key=lambda x: x['numeric_price'])
-
-        # Вземаме първите 2
-        final_cars = [
-            {k: v for k, v in car.items() if k != 'numeric_price'}
-            for car in sorted_cars[:2]
-        ]
-
-        print(f"DEBUG: Финални {len(final_cars)} автомобила за връщане")
-
-        if not final_cars:
-            if model_filter:
-                summary = f"За съжаление, в момента няма налични автомобили, отговарящи на вашето търсене за '{model_filter}'."
-            else:
-                summary = "За съжаление, в момента няма налични автомобили."
-            
-            print(f"DEBUG: Няма намерени автомобили. Summary: {summary}")
-            return {"summary": summary, "cars": []}
-        
-        if model_filter:
-            summary = f"Ето налични автомобили {model_filter}:"
-        else:
-            summary = "Ето налични автомобили:"
-        
-        # Премахваме numeric_price от финалния резултат
-        for car in final_cars:
-            car.pop('numeric_price', None)
-        
-        result = {"summary": summary, "cars": final_cars}
-        print(f"DEBUG: Връщам резултат с {len(result['cars'])} автомобила")
-        return result
-
-    except requests.RequestException as e:
-        print(f"ERROR: Мрежова грешка: {e}")
-        traceback.print_exc()
-        summary = "Възникна грешка при свързването с уебсайта на Peugeot."
-        return {"summary": summary, "cars": []}
-    
-    except ET.ParseError as e:
-        print(f"ERROR: Грешка при парсване на XML: {e}")
-        traceback.print_exc()
-        summary = "Възникна грешка при обработката на данните за автомобили."
-        return {"summary": summary, "cars": []}
-    
-    except Exception as e:
-        print(f"ERROR: Неочаквана грешка: {e}")
-        traceback.print_exc()
-        summary = "Възникна грешка при извличането на данните за автомобили."
-        return {"summary": summary, "cars": []}
+        requests.post(
+            f"https://api.openai.com/v1/threads/{thread_id}/runs/{run_id}/submit_tool_outputs",
+            headers={
+                "Authorization": f"Bearer {OPENAI_API_KEY}",
+                "OpenAI-Beta": "assistants=v2",
+            },
+            json={"tool_outputs": tool_outputs},
+            timeout=30,
+        ).raise_for_status()
+    except Exception:
+        logger.exception("Background submit_tool_outputs failed")
+
+    _flush_messages(rows, session_id=thread_id, is_new_session=is_new_session)
+
 
 @app.route('/')
 def index():
@@ -190,6 +235,37 @@ def admin():
     return render_template('admin.html')
 
 
+# Кеш на неизменимите метаданни на OpenAI файлове (id, име, размер, дата) –
+# попълва се при първото листване и живее колкото процеса.
+_FILE_META_CACHE = {}
+
+
+def _fetch_file_meta(file_id):
+    """Retrieves and caches the immutable metadata for one OpenAI file."""
+    try:
+        file_resp = requests.get(
+            f"https://api.openai.com/v1/files/{file_id}",
+            headers={"Authorization": f"Bearer {OPENAI_API_KEY}"},
+            timeout=30,
+        )
+        file_resp.raise_for_status()
+        info = file_resp.json()
+        created = info.get("created_at")
+        meta = {
+            "id": info.get("id"),
+            "filename": info.get("filename"),
+            "bytes": info.get("bytes"),
+            "created_at": (
+                datetime.utcfromtimestamp(created).isoformat() if created else None
+            ),
+        }
+        _FILE_META_CACHE[file_id] = meta
+        return meta
+    except Exception:
+        # Не кешираме неуспеха – следващото листване ще опита пак
+        return {"id": file_id, "filename": "unknown", "bytes": 0, "created_at": None}
+
+
 @app.route('/api/admin/files', methods=['GET'])
 def list_admin_files():
     """Return list of files in the configured vector store.
@@ -215,46 +291,33 @@ def list_admin_files():
         )
         resp.raise_for_status()
         data = resp.json()
+        vs_files = data.get("data", [])
+
+        # Метаданните на файла са неизменими – при повторно зареждане на
+        # админ страницата взимаме всичко освен статуса от кеша. Липсващите
+        # от кеша id-та се дърпат паралелно: N последователни OpenAI заявки
+        # стават една "вълна" с цена max(latency) вместо sum(latency).
+        missing = [vf["id"] for vf in vs_files if vf.get("id") not in _FILE_META_CACHE]
+        fetched = {}
+        if missing:
+            with ThreadPoolExecutor(max_workers=min(8, len(missing))) as pool:
+                fetched = dict(zip(missing, pool.map(_fetch_file_meta, missing)))
+
         results = []
-        for vf in data.get("data", []):
+        for vf in vs_files:
             file_id = vf.get("id")
-            try:
-                file_resp = requests.get(
-                    f"https://api.openai.com/v1/files/{file_id}",
-                    headers={"Authorization": f"Bearer {OPENAI_API_KEY}"},
-                    timeout=30,
-                )
-                file_resp.raise_for_status()
-                info = file_resp.json()
-                created = info.get("created_at")
-                created_iso = (
-                    datetime.utcfromtimestamp(created).isoformat() if created else None
-                )
-                results.append(
-                    {
-                        "id": info.get("id"),
-                        "filename": info.get("filename"),
-                        "bytes": info.get("bytes"),
-                        "status": vf.get("status"),
-                        "usage_bytes": vf.get("usage_bytes", 0),
-                        "created_at": created_iso,
-                    }
-                )
-            except Exception:
-                results.append(
-                    {
-                        "id": file_id,
-                        "filename": "unknown",
-                        "bytes": 0,
-                        "status": vf.get("status"),
-                        "usage_bytes": vf.get("usage_bytes", 0),
-                        "created_at": None,
-                    }
-                )
+            meta = _FILE_META_CACHE.get(file_id) or fetched[file_id]
+            results.append(
+                {
+                    **meta,
+                    "status": vf.get("status"),
+                    "usage_bytes": vf.get("usage_bytes", 0),
+                }
+            )
         return jsonify(results)
     except Exception as e:
         # Log the error and return an empty list instead of 500
-        print(f"ERROR listing admin files: {e}")
+        logger.exception("Error listing admin files")
         return jsonify([])
 
 
@@ -268,14 +331,20 @@ def upload_admin_file():
 
     file = request.files['file']
     try:
-        headers = {"Authorization": f"Bearer {OPENAI_API_KEY}"}
-        files = {"file": (file.filename, file.stream, file.mimetype)}
-        data = {"purpose": "assistants"}
+        # MultipartEncoder стриймва тялото директно от Werkzeug потока –
+        # requests с files= би буферирал целия файл (plus multipart
+        # рамката) в паметта, преди да изпрати каквото и да е.
+        encoder = MultipartEncoder(fields={
+            "purpose": "assistants",
+            "file": (file.filename, file.stream, file.mimetype or "application/octet-stream"),
+        })
         upload_resp = requests.post(
             "https://api.openai.com/v1/files",
-            headers=headers,
-            files=files,
-            data=data,
+            headers={
+                "Authorization": f"Bearer {OPENAI_API_KEY}",
+                "Content-Type": encoder.content_type,
+            },
+            data=encoder,
             timeout=60,
         )
         upload_resp.raise_for_status()
@@ -293,7 +362,7 @@ def upload_admin_file():
         ).raise_for_status()
         return jsonify({'id': uploaded["id"]}), 201
     except Exception as e:
-        print(f"ERROR uploading file: {e}")
+        logger.exception("Error uploading file")
         return jsonify({'error': str(e)}), 500
 
 
@@ -323,11 +392,50 @@ def delete_admin_file(file_id):
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def _iter_rows(make_query, batch=1000):
+    """Обхожда резултат от PostgREST заявка на страници по batch реда.
+
+    Без limit/range Supabase сериализира цялата таблица в един JSON
+    отговор; с пагинация паметта и размерът на отговора са ограничени до
+    една страница, колкото и да расте историята. make_query е factory,
+    защото builder-ът не може да се преизползва между страниците.
+    """
+    offset = 0
+    while True:
+        rows = make_query().range(offset, offset + batch - 1).execute().data
+        if not rows:
+            return
+        yield from rows
+        if len(rows) < batch:
+            return
+        offset += batch
+
+
 @app.route('/api/threads', methods=['GET'])
 def get_threads():
+    """Return all chat threads with the first user message as title.
+
+    Uses the `thread_summaries` view (see sql/thread_summaries.sql) so the
+    whole list comes back in a single query instead of one chat_messages
+    lookup per session. If the view is missing (migration not applied), we
+    fall back to the old per-session loop so the endpoint keeps working.
+    """
     try:
-        response = supabase.table('chat_sessions').select('session_id, created_at').order('created_at', desc=True).execute()
-        sessions = response.data
+        threads = list(_iter_rows(lambda: (
+            supabase.table('thread_summaries')
+            .select('id, title, created_at')
+            .order('created_at', desc=True)
+        )))
+        return jsonify(threads)
+    except Exception as e:
+        logger.warning("thread_summaries view unavailable, falling back: %s", e)
+
+    try:
+        sessions = list(_iter_rows(lambda: (
+            supabase.table('chat_sessions')
+            .select('session_id, created_at')
+            .order('created_at', desc=True)
+        )))
 
         threads_with_titles = []
         for session in sessions:
@@ -345,15 +453,28 @@ def get_threads():
                     })
             except Exception as e:
                 # Log the error but don't add a broken item to the list
-                print(f"Error processing thread {session.get('session_id', 'N/A')}: {e}")
+                logger.warning("Error processing thread %s: %s", session.get("session_id", "N/A"), e)
 
         return jsonify(threads_with_titles)
-    except Exception as e:
-        traceback.print_exc()
+    except Exception:
+        logger.exception("Failed to retrieve threads")
         return jsonify({"error": "Failed to retrieve threads from database."}), 500
 
+# Кеш на историята по thread_id: страницата (и евентуален монитор) пре-
+# зарежда едни и същи тредове многократно, а редове се добавят само през
+# _flush_messages, което инвалидира ключа. Краткият TTL покрива записи от
+# други процеси/worker-и.
+_MSG_CACHE = {}
+_MSG_CACHE_TTL = 30  # seconds
+_MSG_CACHE_MAX = 2048
+
+
 @app.route('/api/threads/<string:thread_id>/messages', methods=['GET'])
 def get_thread_messages(thread_id):
+    cached = _MSG_CACHE.get(thread_id)
+    if cached and time.time() - cached[0] < _MSG_CACHE_TTL:
+        return jsonify(cached[1])
+
     try:
         # Взимаме и запазените карти, ако има такива
         response = (
@@ -363,11 +484,110 @@ def get_thread_messages(thread_id):
             .order('created_at', desc=False)
             .execute()
         )
+        if len(_MSG_CACHE) >= _MSG_CACHE_MAX:
+            _MSG_CACHE.clear()
+        _MSG_CACHE[thread_id] = (time.time(), response.data)
         return jsonify(response.data)
-    except Exception as e:
-        traceback.print_exc()
+    except Exception:
+        logger.exception("Failed to retrieve messages for thread %s", thread_id)
         return jsonify({"error": "Failed to retrieve messages from database."}), 500
 
+def _sse(payload, event=None):
+    """Форматира един Server-Sent Events фрейм."""
+    frame = f"event: {event}\n" if event else ""
+    return frame + "data: " + orjson.dumps(payload).decode() + "\n\n"
+
+
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    """Стрийминг вариант на /chat (Server-Sent Events).
+
+    Вместо една заявка да блокира до края на run-а, отговорът на асистента
+    се препраща на части още докато се генерира. /chat остава за
+    съвместимост със сегашния фронтенд.
+    """
+    data = request.json
+    thread_id = data.get("thread_id")
+    user_message = data.get("message")
+    is_new_thread = not thread_id
+
+    if is_new_thread:
+        thread = client.beta.threads.create()
+        thread_id = thread.id
+
+    client.beta.threads.messages.create(thread_id=thread_id, role="user", content=user_message)
+    pending_messages = [{"session_id": thread_id, "message": user_message, "is_user": True}]
+
+    def generate():
+        response_parts = []
+        car_data_result = None
+
+        def pump(stream):
+            # Обхожда event-ите от един стрийм; при requires_action подава
+            # tool outputs през нов стрийм и продължава рекурсивно.
+            nonlocal car_data_result
+            for event in stream:
+                if event.event == 'thread.message.delta':
+                    for block in event.data.delta.content or []:
+                        if block.type == 'text' and block.text and block.text.value:
+                            response_parts.append(block.text.value)
+                            yield _sse({"delta": block.text.value})
+                elif event.event == 'thread.run.requires_action':
+                    run = event.data
+                    tool_outputs = []
+                    for tool_call in run.required_action.submit_tool_outputs.tool_calls:
+                        if tool_call.function.name == "get_available_cars":
+                            arguments = orjson.loads(tool_call.function.arguments)
+                            car_data_result = get_available_cars(model_filter=arguments.get('model_filter'))
+                            tool_outputs.append({
+                                "tool_call_id": tool_call.id,
+                                "output": orjson.dumps(car_data_result).decode()
+                            })
+                    if car_data_result and car_data_result.get('cars'):
+                        yield _sse({"cars": car_data_result["cars"]}, event="cars")
+                    with client.beta.threads.runs.submit_tool_outputs_stream(
+                        thread_id=thread_id,
+                        run_id=run.id,
+                        tool_outputs=tool_outputs,
+                    ) as tool_stream:
+                        yield from pump(tool_stream)
+
+        try:
+            yield _sse({"thread_id": thread_id, "is_new_thread": is_new_thread}, event="thread")
+
+            with client.beta.threads.runs.stream(
+                assistant_id=ASSISTANT_ID,
+                thread_id=thread_id,
+                tools=ASSISTANT_TOOLS,
+                instructions=ASSISTANT_INSTRUCTIONS,
+            ) as stream:
+                yield from pump(stream)
+
+            response_text = "".join(response_parts)
+            if car_data_result and car_data_result.get('cars'):
+                response_text = car_data_result.get('summary', "Ето налични автомобили:")
+
+            db_record = {
+                "session_id": thread_id,
+                "message": response_text,
+                "is_user": False,
+            }
+            if car_data_result and car_data_result.get('cars'):
+                db_record["cars"] = car_data_result["cars"]
+            pending_messages.append(db_record)
+            _enqueue_flush(pending_messages, thread_id, is_new_thread)
+
+            yield _sse({"response": response_text}, event="done")
+        except Exception as e:
+            logger.exception("Streaming chat failed")
+            # Записваме поне буферираното дотук (потребителското съобщение
+            # и новата сесия), както прави /chat при неуспешен run
+            _enqueue_flush(pending_messages, thread_id, is_new_thread)
+            yield _sse({"error": f"Възникна грешка: {e}"}, event="error")
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream')
+
+
 @app.route('/chat', methods=['POST'])
 def chat():
     try:
@@ -376,105 +596,127 @@ def chat():
         user_message = data.get("message")
         is_new_thread = not thread_id
 
-        print(f"DEBUG: Chat request - thread_id: {thread_id}, is_new: {is_new_thread}")
+        logger.debug("Chat request - thread_id: %s, is_new: %s", thread_id, is_new_thread)
 
         if is_new_thread:
             thread = client.beta.threads.create()
             thread_id = thread.id
-            print(f"DEBUG: Created new thread: {thread_id}")
-            supabase.table('chat_sessions').insert({"session_id": thread_id}).execute()
+            logger.debug("Created new thread: %s", thread_id)
+            # Редът в chat_sessions се записва при flush-а на съобщенията –
+            # едно RPC вместо отделен insert тук
 
         # Добавяме съобщението на потребителя
         client.beta.threads.messages.create(thread_id=thread_id, role="user", content=user_message)
-        supabase.table('chat_messages').insert({"session_id": thread_id, "message": user_message, "is_user": True}).execute()
-
-        # Стартираме run
-        tools = [
-            {"type": "file_search"},
-            {
-                "type": "function",
-                "function": {
-                    "name": "get_available_cars",
-                    "description": "Извлича списък с налични автомобили от XML фийд. Използвай тази функция, ако потребителят пита за налични коли, цени или конкретни модели.",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "model_filter": {
-                                "type": "string",
-                                "description": "Модел на автомобил за филтриране (напр. '208', '3008')."
-                            }
-                        },
-                        "required": []
-                    }
-                }
-            }
-        ]
 
-        instructions = """
-        Ти си полезен асистент на Peugeot.
-        - За въпроси относно налични автомобили, цени или конкретни модели, ВИНАГИ използвай инструмента `get_available_cars`.
-        - За ВСИЧКИ ДРУГИ въпроси (напр. относно услуги, гаранции, политики, технически спецификации), първо потърси отговор в предоставените файлове чрез твоя `file_search` инструмент.
-        - Отговаряй на български език.
-        """
+        # Буферираме редовете за chat_messages и ги записваме с един bulk
+        # insert в края на заявката вместо с отделен round-trip на съобщение.
+        pending_messages = [{"session_id": thread_id, "message": user_message, "is_user": True}]
 
-        run = client.beta.threads.runs.create(
+        # Стрийминг run вместо poll-ване: сървърът ни бута събитията и
+        # научаваме за терминалния статус / requires_action веднага, без
+        # poll стъпка, а финалното съобщение пристига със самия стрийм.
+        with client.beta.threads.runs.stream(
             assistant_id=ASSISTANT_ID,
             thread_id=thread_id,
-            tools=tools,
-            instructions=instructions
-        )
-        print(f"DEBUG: Started run: {run.id}")
-        
+            tools=ASSISTANT_TOOLS,
+            instructions=ASSISTANT_INSTRUCTIONS,
+        ) as stream:
+            stream.until_done()
+            run = stream.get_final_run()
+            final_messages = stream.get_final_messages() if run.status == 'completed' else []
+        logger.debug("Run %s returned with status: %s", run.id, run.status)
+
         car_data_result = None  # За съхранение на резултата от функцията
-        max_iterations = 30  # Максимум 30 секунди
-        iteration = 0
 
-        while run.status in ['queued', 'in_progress', 'requires_action'] and iteration < max_iterations:
-            run = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
-            print(f"DEBUG: Run status: {run.status} (iteration {iteration})")
-            
-            if run.status == 'requires_action':
-                print(f"DEBUG: Function call required")
-                tool_outputs = []
-                
-                for tool_call in run.required_action.submit_tool_outputs.tool_calls:
-                    print(f"DEBUG: Processing tool call: {tool_call.function.name}")
-                    
-                    if tool_call.function.name == "get_available_cars":
-                        arguments = json.loads(tool_call.function.arguments)
-                        print(f"DEBUG: Function arguments: {arguments}")
-                        
-                        car_data_result = get_available_cars(model_filter=arguments.get('model_filter'))
-                        
-                        tool_outputs.append({
-                            "tool_call_id": tool_call.id,
-                            "output": json.dumps(car_data_result, ensure_ascii=False)
-                        })
-
-                # Изпращаме резултатите обратно към Assistant-а
-                print(f"DEBUG: Submitting tool outputs")
-                client.beta.threads.runs.submit_tool_outputs(
-                    thread_id=thread_id,
-                    run_id=run.id,
-                    tool_outputs=tool_outputs
-                )
-                
-            iteration += 1
-            time.sleep(1)
-
-        print(f"DEBUG: Run completed with status: {run.status}")
+        if run.status == 'requires_action':
+            logger.debug("Function call required")
+            tool_outputs = []
+
+            # При няколко tool calls в един run ги изпълняваме паралелно
+            # на нишки – плащаме max(време) вместо сумата им.
+            car_calls = [
+                tool_call
+                for tool_call in run.required_action.submit_tool_outputs.tool_calls
+                if tool_call.function.name == "get_available_cars"
+            ]
+            if len(car_calls) == 1:
+                results = [get_available_cars(
+                    model_filter=orjson.loads(car_calls[0].function.arguments).get('model_filter')
+                )]
+            elif car_calls:
+                with ThreadPoolExecutor(max_workers=len(car_calls)) as pool:
+                    results = list(pool.map(
+                        lambda tc: get_available_cars(
+                            model_filter=orjson.loads(tc.function.arguments).get('model_filter')
+                        ),
+                        car_calls,
+                    ))
+            else:
+                results = []
+            if car_calls:
+                for tool_call, car_data_result in zip(car_calls, results):
+                    logger.debug("Processed tool call: %s", tool_call.function.name)
+                    tool_outputs.append({
+                        "tool_call_id": tool_call.id,
+                        "output": orjson.dumps(car_data_result).decode()
+                    })
+
+            if car_data_result is not None:
+                # Резултатът за потребителя е готов още тук – submit-ът на
+                # tool outputs и записът в базата стават във фонов режим,
+                # а отговорът с колите тръгва веднага към браузъра.
+                logger.debug("Submitting tool outputs in background")
+                response_text = car_data_result.get('summary', "Ето налични автомобили:")
+                db_record = {
+                    "session_id": thread_id,
+                    "message": response_text,
+                    "is_user": False,
+                }
+                if car_data_result.get('cars'):
+                    db_record["cars"] = car_data_result["cars"]
+                pending_messages.append(db_record)
+                _BG.submit(_finish_tool_run, thread_id, run.id, tool_outputs, pending_messages, is_new_thread)
+
+                response_data = {
+                    "response": response_text,
+                    "thread_id": thread_id,
+                    "is_new_thread": is_new_thread
+                }
+                if car_data_result.get('cars'):
+                    response_data["cars"] = car_data_result['cars']
+                return jsonify(response_data)
+
+            # Изпращаме резултатите обратно към Assistant-а и изчакваме
+            # run-а да завърши (отново през стрийм, без poll-ване)
+            logger.debug("Submitting tool outputs")
+            with client.beta.threads.runs.submit_tool_outputs_stream(
+                thread_id=thread_id,
+                run_id=run.id,
+                tool_outputs=tool_outputs,
+            ) as tool_stream:
+                tool_stream.until_done()
+                run = tool_stream.get_final_run()
+                if run.status == 'completed':
+                    final_messages = tool_stream.get_final_messages()
+
+        logger.debug("Run completed with status: %s", run.status)
 
         if run.status == 'completed':
-            # Получаваме финалния отговор от Assistant-а
-            messages = client.beta.threads.messages.list(thread_id=thread_id, order="desc", limit=1)
-            response_text = messages.data[0].content[0].text.value
-            print(f"DEBUG: Assistant response: {response_text[:100]}...")
+            # Финалният отговор идва със стрийма – messages.list остава
+            # само като резервен път, ако стриймът не е донесъл съобщение.
+            if final_messages:
+                response_text = final_messages[-1].content[0].text.value
+            else:
+                messages = client.beta.threads.messages.list(thread_id=thread_id, order="desc", limit=1)
+                response_text = messages.data[0].content[0].text.value
+            logger.debug("Assistant response: %.100s...", response_text)
 
             # Ако имаме данни за коли, показваме кратко описание
             if car_data_result and car_data_result.get('cars'):
                 response_text = car_data_result.get('summary', "Ето налични автомобили:")
 
-            # Записваме отговора в базата и съхраняваме картите за колите
+            # Записваме отговора в базата във фонов режим – клиентът не
+            # чака Supabase да потвърди
             db_record = {
                 "session_id": thread_id,
                 "message": response_text,
@@ -482,7 +724,8 @@ def chat():
             }
             if car_data_result and car_data_result.get('cars'):
                 db_record["cars"] = car_data_result["cars"]
-            supabase.table('chat_messages').insert(db_record).execute()
+            pending_messages.append(db_record)
+            _enqueue_flush(pending_messages, thread_id, is_new_thread)
 
             # Ако имаме данни за коли, ги включваме в отговора
             response_data = {
@@ -493,23 +736,25 @@ def chat():
 
             if car_data_result and car_data_result.get('cars'):
                 response_data["cars"] = car_data_result['cars']
-                print(f"DEBUG: Including {len(car_data_result['cars'])} cars in response")
+                logger.debug("Including %d cars in response", len(car_data_result["cars"]))
 
             return jsonify(response_data)
             
         elif run.status == 'failed':
             error_message = f"Грешка: Обработката неуспешна. Причина: {run.last_error.message if run.last_error else 'Неизвестна грешка'}"
-            print(f"DEBUG: Run failed: {error_message}")
+            logger.debug("Run failed: %s", error_message)
+            # Записваме поне потребителското съобщение
+            _enqueue_flush(pending_messages, thread_id, is_new_thread)
             return jsonify({"response": error_message, "thread_id": thread_id, "is_new_thread": is_new_thread})
-            
+
         else:
-            error_message = f"Грешка: Обработката спря със статус '{run.status}' след {iteration} итерации."
-            print(f"DEBUG: Run ended with unexpected status: {run.status}")
+            error_message = f"Грешка: Обработката спря със статус '{run.status}'."
+            logger.debug("Run ended with unexpected status: %s", run.status)
+            _enqueue_flush(pending_messages, thread_id, is_new_thread)
             return jsonify({"response": error_message, "thread_id": thread_id, "is_new_thread": is_new_thread})
 
     except Exception as e:
-        print(f"ERROR: Critical server error: {e}")
-        traceback.print_exc()
+        logger.exception("Critical server error")
         error_message = f"Възникна критична грешка на сървъра: {e}"
         return jsonify({"error": error_message}), 500
 
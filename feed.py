@@ -0,0 +1,325 @@
+"""Product feed helpers: fetch, parse, cache and filter the Peugeot XML feed.
+
+Самостоятелен модул, за да има само една имплементация на кеширания път
+(fetch -> parse -> сортиран кеш -> филтър) и app.py да държи само HTTP
+слоя и интеграциите с OpenAI/Supabase.
+"""
+
+import functools
+import logging
+import re
+import threading
+import time
+
+import requests
+from urllib3.util.retry import Retry
+from lxml import etree
+from operator import attrgetter
+from dataclasses import dataclass
+
+logger = logging.getLogger(__name__)
+
+# Преизползваме една HTTP сесия за фийда, за да не плащаме нов TCP + TLS
+# handshake към sale.peugeot.bg при всяко опресняване на кеша. Adapter-ът
+# дава pool за няколко нишки + кратък retry при мрежови грешки.
+_HTTP = requests.Session()
+_HTTP.mount('https://', requests.adapters.HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(total=2, backoff_factor=0.3),
+))
+_HTTP.headers.update({
+    # brotli компресира XML осезаемо по-добре от gzip; urllib3 декодира
+    # "br" прозрачно, стига пакетът brotli да е инсталиран
+    'Accept-Encoding': 'gzip, br',
+    'User-Agent': 'ai-sale-python/1.0',
+})
+
+# Cache for car data to reduce XML fetches. Besides the parsed cars we keep
+# the validators from the last успешен отговор (ETag / Last-Modified), за да
+# можем да правим условни заявки и да пропускаме download + parse при 304.
+CAR_CACHE = {"timestamp": 0, "cars": [], "etag": None, "last_modified": None, "refreshing": False}
+_REFRESH_LOCK = threading.Lock()
+CACHE_TTL = 300  # seconds
+
+# Предварително резолвнати namespaced тагове от Google Merchant фийда,
+# за да не се прави namespace lookup при всеки .find()
+_GNS = '{http://base.google.com/ns/1.0}'
+T_AVAILABILITY = _GNS + 'availability'
+T_TITLE = _GNS + 'title'
+T_DESCRIPTION = _GNS + 'description'
+T_LINK = _GNS + 'link'
+T_IMAGE_LINK = _GNS + 'image_link'
+
+# Компилираме шаблона за цена веднъж при import, а не при всяко извикване
+_PRICE_RE = re.compile(r'([\d\s,]+)\s*лв')
+# Една C-ниво транслация вместо две последователни .replace()
+_PRICE_TBL = str.maketrans({' ': '', '\xa0': '', ',': '.'})
+# Sentinel за "няма цена" – изчислен веднъж вместо float('inf') в hot path
+INF = float('inf')
+
+
+@dataclass(slots=True)
+class Car:
+    """Един автомобил от фийда, в компактна форма за кеша.
+
+    Слотовете спестяват dict overhead на запис – кешът държи целия фийд в
+    паметта на всеки worker. numeric_price и model_ci са служебни полета,
+    изчислени веднъж при парсване.
+    """
+    model: str
+    price: str
+    link: str
+    image_url: str
+    numeric_price: float
+    model_ci: str
+
+    def to_public_dict(self):
+        """Полетата, които връщаме на клиента (без служебните)."""
+        return {
+            "model": self.model,
+            "price": self.price,
+            "link": self.link,
+            "image_url": self.image_url,
+        }
+
+
+def parse_price(price_str):
+    """Extracts the price in BGN from a string like '35 858,96 € / 70 134,03 лв.'"""
+    if not price_str:
+        return INF
+
+    # Бърз път без regex: цената в лева е последното число преди "лв",
+    # евентуално след "/" разделител. Само C-ниво string операции.
+    head, sep, _ = price_str.rpartition('лв')
+    if sep:
+        try:
+            return float(head.rstrip().rsplit('/', 1)[-1].translate(_PRICE_TBL))
+        except ValueError:
+            pass  # нестандартен формат – пробваме с регулярния израз
+
+    # Резервен път: търсим цена в лева с регулярния израз
+    match = _PRICE_RE.search(price_str)
+    if match:
+        try:
+            # Премахваме интервали и заменяме запетаи с точки
+            price_clean = match.group(1).translate(_PRICE_TBL)
+            return float(price_clean)
+        except (ValueError, TypeError):
+            logger.debug("Грешка при парсване на цена: %s", price_str)
+            return INF
+
+    logger.debug("Не е намерена цена в лева в: %s", price_str)
+    return INF
+
+
+def _refresh_feed_cache():
+    """Fetches, parses and atomically swaps the cached car list."""
+    now = time.time()
+    url = "https://sale.peugeot.bg/ecommerce/fb/product_feed.xml"
+    logger.debug("Fetching XML from: %s", url)
+
+    # Условна заявка: ако фийдът не е променен, сървърът връща 304 без тяло
+    # и използваме вече парснатите данни.
+    headers = {}
+    if CAR_CACHE["etag"]:
+        headers["If-None-Match"] = CAR_CACHE["etag"]
+    if CAR_CACHE["last_modified"]:
+        headers["If-Modified-Since"] = CAR_CACHE["last_modified"]
+
+    response = _HTTP.get(url, headers=headers, timeout=15, stream=True)
+
+    if response.status_code == 304 and CAR_CACHE["cars"]:
+        logger.debug("Feed not modified (304), reusing parsed car data")
+        response.close()
+        CAR_CACHE["timestamp"] = now
+        return CAR_CACHE["cars"]
+
+    response.raise_for_status()
+    logger.debug("XML response status: %s", response.status_code)
+
+    # Стриймваме парсването с iterparse директно от мрежовия поток, без да
+    # материализираме цялото тяло: обхождаме всеки <item> веднъж и го
+    # освобождаваме с elem.clear()
+    response.raw.decode_content = True
+    all_cars = []
+    item_count = 0
+    # lxml (libxml2) парсва в C и с tag='item' ни дава само интересните
+    # елементи, без Python-ниво проверка на всеки таг.
+    for event, elem in etree.iterparse(response.raw, events=('end',), tag='item'):
+        item_count += 1
+
+        # Едно обхождане на децата вместо отделен findtext (= ново
+        # обхождане) за всяко от петте полета
+        availability = title = description = link = image_url = None
+        for child in elem:
+            tag = child.tag
+            if tag == T_AVAILABILITY:
+                availability = child.text
+            elif tag == T_TITLE:
+                title = child.text
+            elif tag == T_DESCRIPTION:
+                description = child.text
+            elif tag == T_LINK:
+                link = child.text
+            elif tag == T_IMAGE_LINK:
+                image_url = child.text
+
+        if availability == 'in stock':
+            title = title.strip() if title else "N/A"
+            description = description.strip() if description else "N/A"
+
+            all_cars.append(Car(
+                model=title,
+                price=description,
+                link=link or "#",
+                image_url=image_url or "",
+                numeric_price=parse_price(description),
+                # casefold вместо lower: коректно за не-ASCII заглавия и
+                # се изчислява веднъж на кола при парсване, не на заявка
+                model_ci=title.casefold(),
+            ))
+
+        # Освобождаваме елемента веднага, за да не държим целия фийд в
+        # паметта, и махаме вече обработените siblings от родителя – иначе
+        # lxml ги трупа в дървото до края на парсването.
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+    logger.debug("Намерени общо %d елемента в XML", item_count)
+
+    # Пазим списъка предварително сортиран по цена – така обработката на
+    # заявка се свежда до филтър + slice.
+    all_cars.sort(key=attrgetter('numeric_price'))
+
+    CAR_CACHE["timestamp"] = now
+    CAR_CACHE["cars"] = all_cars
+    CAR_CACHE["etag"] = response.headers.get("ETag")
+    CAR_CACHE["last_modified"] = response.headers.get("Last-Modified")
+    logger.debug("Събрани данни за %d автомобила", len(all_cars))
+    return all_cars
+
+
+def _refresh_cache_bg():
+    """Opportunistic refresh used by the stale-while-revalidate path."""
+    try:
+        _refresh_feed_cache()
+    except Exception:
+        logger.exception("Background cache refresh failed")
+    finally:
+        with _REFRESH_LOCK:
+            CAR_CACHE["refreshing"] = False
+
+
+def fetch_all_cars():
+    """Returns the cached car data, refreshing from the XML feed if stale."""
+    cars = CAR_CACHE["cars"]
+    if cars and time.time() - CAR_CACHE["timestamp"] < CACHE_TTL:
+        logger.debug("Using cached car data")
+        return cars
+
+    if cars:
+        # Stale-while-revalidate: връщаме веднага застоялия списък, а
+        # опресняването тръгва на фонова нишка (най-много една наведнъж).
+        with _REFRESH_LOCK:
+            already_refreshing = CAR_CACHE["refreshing"]
+            CAR_CACHE["refreshing"] = True
+        if not already_refreshing:
+            threading.Thread(target=_refresh_cache_bg, daemon=True, name="feed-swr").start()
+        return cars
+
+    # Студен кеш – няма какво да сервираме, затова блокираме до първия fetch
+    return _refresh_feed_cache()
+
+
+def _feed_refresh_loop():
+    """Опреснява кеша с коли на всеки CACHE_TTL секунди на фонова нишка.
+
+    Така кешът е зареден още преди първата заявка и никой потребител не
+    плаща цената на fetch + parse в своя request.
+    """
+    while True:
+        try:
+            _refresh_feed_cache()
+        except Exception:
+            logger.exception("Background feed refresh failed")
+        time.sleep(CACHE_TTL)
+
+
+threading.Thread(target=_feed_refresh_loop, daemon=True, name="feed-refresh").start()
+
+
+@functools.lru_cache(maxsize=32)
+def _filter_cars(cache_stamp, needle):
+    """Връща първите две кеширани коли, съдържащи needle в модела.
+
+    Списъкът е предварително сортиран по цена, така че първите две
+    съвпадения са и двете най-евтини – scan-ът спира рано вместо да
+    обхожда целия фийд. cache_stamp е timestamp-ът на фийд кеша: при
+    всяко опресняване ключът се сменя и LRU-то се инвалидира от само
+    себе си. Популярните филтри ("208", "3008"...) стават dict lookup.
+    """
+    matches = []
+    for car in CAR_CACHE["cars"]:
+        if needle in car.model_ci:
+            matches.append(car)
+            if len(matches) == 2:
+                break
+    return matches
+
+
+def get_available_cars(model_filter=None):
+    """Fetches, filters, sorts by price, and returns the top 2 cheapest cars."""
+    logger.debug("Calling get_available_cars function. Filter: %s", model_filter)
+
+    try:
+        all_cars = fetch_all_cars()
+        logger.debug("Общо налични автомобили: %d", len(all_cars))
+
+        # Филтриране по модел ако е зададен. Кешираният списък е вече
+        # сортиран по цена, така че остава само филтър + slice.
+        if model_filter:
+            logger.debug("Филтриране по модел: %s", model_filter)
+            filtered_cars = _filter_cars(CAR_CACHE["timestamp"], model_filter.casefold())
+            logger.debug("След филтриране останаха %d автомобила", len(filtered_cars))
+        else:
+            filtered_cars = all_cars
+
+        # Вземаме първите 2 (най-евтините) без служебните полета
+        final_cars = [car.to_public_dict() for car in filtered_cars[:2]]
+
+        logger.debug("Финални %d автомобила за връщане", len(final_cars))
+
+        if not final_cars:
+            if model_filter:
+                summary = f"За съжаление, в момента няма налични автомобили, отговарящи на вашето търсене за '{model_filter}'."
+            else:
+                summary = "За съжаление, в момента няма налични автомобили."
+
+            logger.debug("Няма намерени автомобили. Summary: %s", summary)
+            return {"summary": summary, "cars": []}
+
+        if model_filter:
+            summary = f"Ето налични автомобили {model_filter}:"
+        else:
+            summary = "Ето налични автомобили:"
+
+        result = {"summary": summary, "cars": final_cars}
+        logger.debug("Връщам резултат с %d автомобила", len(result["cars"]))
+        return result
+
+    except requests.RequestException as e:
+        logger.exception("Мрежова грешка при взимане на фийда")
+        summary = "Възникна грешка при свързването с уебсайта на Peugeot."
+        return {"summary": summary, "cars": []}
+
+    except etree.XMLSyntaxError as e:
+        logger.exception("Грешка при парсване на XML")
+        summary = "Възникна грешка при обработката на данните за автомобили."
+        return {"summary": summary, "cars": []}
+
+    except Exception as e:
+        logger.exception("Неочаквана грешка в get_available_cars")
+        summary = "Възникна грешка при извличането на данните за автомобили."
+        return {"summary": summary, "cars": []}
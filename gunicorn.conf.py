@@ -0,0 +1,13 @@
+# Gunicorn configuration (picked up automatically from the working dir).
+#
+# Работата на приложението е почти изцяло I/O (OpenAI, Supabase, XML фийд),
+# затова вдигаме конкурентността с нишки вместо с процеси: малко workers,
+# много threads на worker. Придържаме се към обикновени нишки вместо
+# gevent monkey-patching – фоновите нишки (feed refresh, chat writer) и
+# httpx транспортът на OpenAI SDK-то работят с тях без изненади.
+import os
+
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "16"))
+timeout = 120
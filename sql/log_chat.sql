@@ -0,0 +1,22 @@
+-- Writes one chat turn (session row if new + buffered messages) in a single
+-- transaction, so the app needs one round-trip instead of two or three.
+-- Run this once against the Supabase project (SQL editor or migration).
+CREATE OR REPLACE FUNCTION log_chat(p_session_id text, p_is_new boolean, p_messages jsonb)
+RETURNS void
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF p_is_new THEN
+        INSERT INTO chat_sessions (session_id)
+        VALUES (p_session_id)
+        ON CONFLICT DO NOTHING;
+    END IF;
+
+    INSERT INTO chat_messages (session_id, message, is_user, cars)
+    SELECT p_session_id,
+           m->>'message',
+           (m->>'is_user')::boolean,
+           m->'cars'
+    FROM jsonb_array_elements(p_messages) AS m;
+END;
+$$;
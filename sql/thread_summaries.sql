@@ -0,0 +1,21 @@
+-- View used by /api/threads to fetch all sessions together with the first
+-- user message in a single query, instead of one chat_messages SELECT per
+-- session from Python. Run this once against the Supabase project
+-- (SQL editor or migration).
+CREATE OR REPLACE VIEW thread_summaries AS
+SELECT
+    s.session_id AS id,
+    s.created_at,
+    (
+        SELECT m.message
+        FROM chat_messages m
+        WHERE m.session_id = s.session_id AND m.is_user
+        ORDER BY m.created_at
+        LIMIT 1
+    ) AS title
+FROM chat_sessions s
+WHERE EXISTS (
+    SELECT 1
+    FROM chat_messages m2
+    WHERE m2.session_id = s.session_id AND m2.is_user
+);